@@ -21,14 +21,105 @@ from reportlab.lib.pagesizes import letter, landscape
 from reportlab.pdfgen import canvas
 from reportlab.lib.colors import Color
 from reportlab.lib import colors
+from reportlab.lib.utils import ImageReader
+from reportlab import rl_config
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 import argparse
-import math
-
-def drawRectangle(c, minx, miny, maxx, maxy):
-    c.line(minx, miny, maxx, miny)
-    c.line(minx, maxy, maxx, maxy)
-    c.line(minx, miny, minx, maxy)
-    c.line(maxx, miny, maxx, maxy)
+import io
+import os
+
+class JPEGReader(ImageReader):
+    """ImageReader for JPEG bytes already in memory"""
+
+    def __init__(self, data):
+        ImageReader.__init__(self, io.BytesIO(data))
+        self._jpeg_data = data
+
+    # drawImage only calls getRGBData to build the digest it dedups images
+    # by, so the JPEG bytes serve just as well and save decoding every page
+    def getRGBData(self):
+        self._dataA = None
+        return self._jpeg_data
+
+def threshold_image(im):
+    """Threshold a mode 'L' image at 128 to a mode '1' image"""
+    return im.convert('1', dither=Image.NONE)
+
+def make_palette(im, num_colors):
+    """Pick an adaptive palette of at most num_colors entries for im"""
+    # the palette only needs colour statistics, so pick it from a copy of
+    # about a megapixel rather than quantizing the whole source
+    factor = max(1, int((im.width * im.height / 1000000) ** 0.5))
+    # returned as a 1x1 mode 'P' image, which is all Image.quantize needs
+    palette = Image.new('P', (1, 1))
+    palette.putpalette(im.reduce(factor).quantize(colors=num_colors).getpalette())
+    return palette
+
+# The source image and optional palette, handed to each worker process
+# once by _init_worker rather than pickled with every page.
+_worker_image = None
+_worker_palette = None
+
+def _init_worker(im, palette=None):
+    global _worker_image, _worker_palette
+    _worker_image = im
+    _worker_palette = palette
+
+def render_segment(size, src_box, threshold=False, jpeg_quality=90):
+    """Resample and encode one page's piece of the source image"""
+    if size == (src_box[2] - src_box[0], src_box[3] - src_box[1]):
+        # the source is already at poster resolution, so there is nothing
+        # to resample and a plain crop does the job
+        segment = _worker_image.crop(src_box)
+    else:
+        # Bilinear rather than nearest neighbor, so upscaled pages aren't
+        # blocky.  When scaling down by 3x or more, reducing_gap has Pillow
+        # first shrink by an integer factor with its fast box reducer.
+        segment = _worker_image.resize(size, Image.BILINEAR, box=src_box, reducing_gap=3.0)
+    if threshold:
+        segment = threshold_image(segment)
+    elif _worker_palette is not None:
+        # map onto the shared palette after scaling, so every page uses the
+        # same colours and scaling still gets to blend them
+        segment = segment.quantize(palette=_worker_palette, dither=Image.NONE)
+    if segment.mode in ('1', 'P'):
+        return segment
+    buf = io.BytesIO()
+    segment.save(buf, 'JPEG', quality=jpeg_quality)
+    return buf.getvalue()
+
+def generate_segments(im, pages, threshold=False, jpeg_quality=90, jobs=None, palette=None):
+    """Render pages in a process pool, yielding them in order"""
+    # at least one worker, so a poster with no pages just yields nothing
+    workers = max(1, min(jobs or os.cpu_count() or 1, len(pages)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(im, palette)) as pool:
+        pending = deque()
+        for row, col, size, src_box in pages:
+            pending.append((row, col, size, pool.submit(render_segment, size, src_box, threshold, jpeg_quality)))
+            if len(pending) > 2 * workers:
+                row, col, size, future = pending.popleft()
+                yield row, col, size, future.result()
+        while pending:
+            row, col, size, future = pending.popleft()
+            yield row, col, size, future.result()
+
+def draw_segment(c, segment, x, y, width, height):
+    """Draw a segment produced by render_segment on the canvas"""
+    if isinstance(segment, Image.Image) and segment.mode == 'P':
+        c.drawImage(ImageReader(segment), x, y, width=width, height=height)
+    elif isinstance(segment, Image.Image):
+        # 1-bit images stay inline, the only path where reportlab keeps them
+        # at one bit per pixel.  It builds page streams as text, so inline
+        # image data still has to be ASCII85 encoded.
+        use_a85 = rl_config.useA85
+        rl_config.useA85 = 1
+        try:
+            c.drawInlineImage(segment, x, y, width=width, height=height)
+        finally:
+            rl_config.useA85 = use_a85
+    else:
+        c.drawImage(JPEGReader(segment), x, y, width=width, height=height)
 
 def parse_size(size_str):
     """Parse size string like '20x30' or '24x36' into width, height tuple"""
@@ -78,8 +169,9 @@ def calculate_pages_needed(poster_width, poster_height, dpi=300, overlap_in=0.5,
     if sheet_px_w <= overlap_px or sheet_px_h <= overlap_px:
         return float('inf'), float('inf') # Avoid division by zero or negative
 
-    cols = math.ceil((poster_px_w - overlap_px) / (sheet_px_w - overlap_px)) if sheet_px_w > overlap_px else 1
-    rows = math.ceil((poster_px_h - overlap_px) / (sheet_px_h - overlap_px)) if sheet_px_h > overlap_px else 1
+    # ceiling division, kept in integers
+    cols = -(-(poster_px_w - overlap_px) // (sheet_px_w - overlap_px))
+    rows = -(-(poster_px_h - overlap_px) // (sheet_px_h - overlap_px))
     
     return cols, rows
 
@@ -103,7 +195,8 @@ def parse_color(color_str):
             raise ValueError(f"Unknown color name: {color_str}")
 
 def split_image_to_letter_overlap(image_path, output_pdf, poster_width=20, poster_height=30, dpi=300, overlap_in=0.5,
-        args=None, rotated=False, line_color_str="black", margin_x=0.375, margin_y=0.375, paper_size=(8.5, 11.0)):
+        args=None, rotated=False, line_color_str="black", margin_x=0.375, margin_y=0.375, paper_size=(8.5, 11.0),
+        jobs=None, jpeg_quality=90, num_colors=None):
 
     # Hopelessly U.S. centric, no A sizes here...
     paper_w, paper_h = paper_size
@@ -114,13 +207,18 @@ def split_image_to_letter_overlap(image_path, output_pdf, poster_width=20, poste
     poster_px_h = int(poster_height * dpi)
     sheet_px_w = int(letter_w * dpi)            # sheet_px_w is in pixels...
     sheet_px_h = int(letter_h * dpi)            # sheet_px_h is in pixels...
+    bw = bool(args and args.black_and_white)
 
     print(f"Poster size: {poster_width}\" x {poster_height}\"")
     print(f"DPI: {dpi}")
     print(f"Overlap: {overlap_in}\"")
     print(f"Black and white: {args.black_and_white if args else False}")
     print(f"Line color: {line_color_str}")
+    print(f"JPEG quality: {jpeg_quality}")
+    print(f"Colors: {'n/a' if bw else num_colors or 'full'}")
     print(f"Paper size: {paper_w} x {paper_h}")
+    if num_colors and bw:
+        print("Warning: --colors has no effect in black and white mode")
 
 
     try:
@@ -129,52 +227,106 @@ def split_image_to_letter_overlap(image_path, output_pdf, poster_width=20, poste
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
     
-    im = Image.open(image_path)
+    # image_path may also be an already opened image.  Drop that reference
+    # so the decoded source can be freed as soon as rotate/convert replace it.
+    im = image_path if isinstance(image_path, Image.Image) else Image.open(image_path)
+    image_path = None
+
+    # For JPEGs bigger than the poster, have libjpeg scale down by 1/2, 1/4
+    # or 1/8 while decoding; it never goes below the size asked for.  This
+    # is a no-op for other formats.
+    draft_size = (poster_px_h, poster_px_w) if rotated else (poster_px_w, poster_px_h)
+    full_size = im.size
+    im.draft('L' if bw else 'RGB', draft_size)
+    if im.size != full_size:
+        print(f"Decoding JPEG at {im.size[0]}x{im.size[1]} instead of {full_size[0]}x{full_size[1]}")
+
     if rotated:
         im = im.rotate(90, expand=True)
 
-    if args and args.black_and_white:
+    # the aspect ratio check below wants the real size, not the draft size
+    input_ratio = full_size[1] / full_size[0] if rotated else full_size[0] / full_size[1]
+
+    if bw:
+        # thresholding happens per page, after scaling, so edges stay smooth
         im = im.convert('L')
-        im = im.point(lambda p : 0 if p < 128 else 255)
-        im = im.convert('1')
         print("... converted to black and white")
     else:
         im = im.convert('RGB')
     iw, ih = im.size
 
+    palette = None
+    if num_colors and not bw:
+        palette = make_palette(im, num_colors)
+        print(f"... reduced to a {num_colors} color palette")
+
     # If the input matches the target ratio, scale it up or down to match poster size
     target_ratio = poster_px_w / poster_px_h
-    input_ratio = iw / ih
     if abs(target_ratio - input_ratio) > 1e-4:
         print(f"Warning: input aspect ratio {input_ratio:.4f} != target {target_ratio:.4f}")
 
-    print(f"Resizing image to {poster_px_w}x{poster_px_h}...", end="")
-
-    if iw != poster_px_w or ih != poster_px_h:
-        im = im.resize((poster_px_w, poster_px_h), Image.NEAREST)
-    print("done.")
+    # Rather than resizing the whole image up to poster resolution (which for
+    # a 20x30 poster at 300 dpi is a ~160MB buffer), each page resamples just
+    # its own piece of the original image.  These map poster pixels back to
+    # source pixels.
+    scale_x = iw / poster_px_w
+    scale_y = ih / poster_px_h
+    print(f"Scaling image {iw}x{ih} to {poster_px_w}x{poster_px_h} one page at a time")
 
     # Calculate pages needed
     cols, rows = calculate_pages_needed(poster_width, poster_height, dpi, overlap_in, margin_x, margin_y, paper_w, paper_h)
     
     print(f"Will need {cols} columns x {rows} rows = {cols * rows} total pages")
 
-    page_layout = landscape(letter) if paper_w > paper_h else letter
-    c = canvas.Canvas(output_pdf, pagesize=page_layout)
-
-    for row in range(rows):
-        for col in range(cols):
-            left = col * (sheet_px_w - overlap_px)
-            upper = row * (sheet_px_h - overlap_px)
-            right = min(left + sheet_px_w, poster_px_w)
-            lower = min(upper + sheet_px_h, poster_px_h)
-            box = (left, upper, right, lower)
-            segment = im.crop(box)
-
-            # crop the image... I believe that his can return 
-            # an image which is smaller than that specified by "box"
-
-            w, h = segment.size
+    # By default reportlab wraps every stream in ASCII85, which makes the PDF
+    # 25% bigger and, without its C accelerator, takes longer than everything
+    # else put together.  Plain binary streams are fine for any PDF reader.
+    # reportlab only reads the setting as it writes streams, so it has to
+    # stay in place until the PDF is saved.
+    use_a85 = rl_config.useA85
+    rl_config.useA85 = 0
+    try:
+        page_layout = landscape(letter) if paper_w > paper_h else letter
+        # Flate compress the page streams regardless of the local reportlab
+        # configuration; the line art and inline 1-bit images shrink a lot
+        c = canvas.Canvas(output_pdf, pagesize=page_layout, pageCompression=1)
+
+        # Everything below that doesn't depend on the page, worked out once.
+        # Positions on the PDF page are in points (1/72").
+        step_px_x = sheet_px_w - overlap_px
+        step_px_y = sheet_px_h - overlap_px
+        pt_per_px_x = letter_w * 72 / sheet_px_w
+        pt_per_px_y = letter_h * 72 / sheet_px_h
+        m_x = margin_x * 72
+        m_y = margin_y * 72
+        letter_w_pt = letter_w * 72
+        letter_h_pt = letter_h * 72
+        overlap_pt = overlap_in * 72
+        left_line_x = m_x + overlap_pt
+        right_line_x = m_x + letter_w_pt - overlap_pt
+        top_line_y = m_y + letter_h_pt - overlap_pt
+        bottom_line_y = m_y + overlap_pt
+
+        # Work out every page's piece of the poster up front, so the pages can
+        # be resampled and encoded in parallel.  Only drawing them onto the
+        # canvas has to happen in order.
+        # Pages in a column share their horizontal extent and pages in a row
+        # their vertical one, so these are computed per column and per row
+        # rather than per page.  The last column and row can be short.
+        col_spans = [(col * step_px_x, min(col * step_px_x + sheet_px_w, poster_px_w)) for col in range(cols)]
+        row_spans = [(row * step_px_y, min(row * step_px_y + sheet_px_h, poster_px_h)) for row in range(rows)]
+        # Alignment lines mark the overlap with neighbouring pages, so which
+        # ones a page gets depends only on its column and row.
+        col_line_xs = [([left_line_x] if col > 0 else []) + ([right_line_x] if col < cols - 1 else [])
+                       for col in range(cols)]
+        row_line_ys = [([top_line_y] if row > 0 else []) + ([bottom_line_y] if row < rows - 1 else [])
+                       for row in range(rows)]
+
+        pages = [(row, col, (right - left, lower - upper), (left * scale_x, upper * scale_y, right * scale_x, lower * scale_y))
+                 for row, (upper, lower) in enumerate(row_spans)
+                 for col, (left, right) in enumerate(col_spans)]
+
+        for row, col, (w, h), segment in generate_segments(im, pages, bw, jpeg_quality, jobs, palette):
             print(f"Page {row * cols + col + 1:2d}: Image segment {col+1}x{row+1} has size {w}x{h}")
 
             print(f"height = {h}")
@@ -184,62 +336,46 @@ def split_image_to_letter_overlap(image_path, output_pdf, poster_width=20, poste
             print(f"offset = {offset} inches")
             print(f"letter_h = {letter_h}")
 
-            # Draw segment on PDF page using drawInlineImage
-            c.drawInlineImage(
-                segment,
-                margin_x*72, 
-                (margin_y+offset)*72 if row == rows-1 else margin_y * 72,
-                width=(letter_w * 72) * float(w) / sheet_px_w,  
-                height=(letter_h * 72) * float(h) / sheet_px_h
-            )
+            width_pt = pt_per_px_x * w
+            height_pt = pt_per_px_y * h
+
+            # for the last row, the image is aligned to the top of the
+            # page.  The offset calculation determines the amount of blank
+            # space at the bottom of the page.
+            bottom = m_y + offset * 72 if row == rows - 1 else m_y
+
+            # Draw segment on PDF page
+            draw_segment(c, segment, m_x, bottom, width=width_pt, height=height_pt)
 
             # Draw prominent alignment lines
+            # reportlab resets the graphics state on every page, so the colour
+            # has to be set each time.  The 1pt line width is the PDF default.
             c.setStrokeColor(line_color)
-            c.setLineWidth(1)
             c.setDash(1, 8)
 
-            m_x = margin_x * 72
-            m_y = margin_y * 72
-
             minx = m_x
-            maxx = m_x + (letter_w * float(w) / sheet_px_w) * 72
-
-            miny = m_y
-            maxy = m_y + (letter_h * float(h) / sheet_px_h) * 72
-            if row == rows - 1:
-                miny = m_y + offset * 72
-                maxy = m_y + offset * 72 + (letter_h * float(h) / sheet_px_h) * 72
-
-            if col > 0:
-                x = overlap_in * 72
-                c.line(x+m_x, miny, x+m_x, maxy)
-            if col < cols - 1:
-                x = (letter_w - overlap_in) * 72
-                c.line(x+m_x, miny, x+m_x, maxy)
-
-            if row > 0:
-                y = (letter_h - overlap_in) * 72
-                c.line(minx, y+m_y, maxx, y+m_y)
-            if row < rows - 1:
-                y = overlap_in * 72
-                c.line(minx, y+m_y, maxx, y+m_y)
+            maxx = m_x + width_pt
+            miny = bottom
+            maxy = bottom + height_pt
+
+            # collect all the lines into one path so they are stroked once
+            p = c.beginPath()
+            for x in col_line_xs[col]:
+                p.moveTo(x, miny)
+                p.lineTo(x, maxy)
+            for y in row_line_ys[row]:
+                p.moveTo(minx, y)
+                p.lineTo(maxx, y)
+            if rows > 1 or cols > 1:
+                c.drawPath(p, stroke=1, fill=0)
 
             # set a dashed box around the image area...
             c.setDash(6, 3)
-            
-            maxx = m_x + letter_w * 72
-            if col == cols - 1:
-                maxx = m_x + (letter_w * float(w) / sheet_px_w) * 72
-
-            miny = m_y
-            maxy = m_y + letter_h * 72
-            if row == rows - 1:
-                # for the last row, the image is aligned to the top of the
-                # page.  The offset calculation determines the amount of blank
-                # space at the bottom of the page.
-                miny = m_y + offset * 72
-            
-            drawRectangle(c, m_x, miny, maxx, maxy)
+
+            maxx = m_x + width_pt if col == cols - 1 else m_x + letter_w_pt
+            maxy = m_y + letter_h_pt
+
+            c.rect(m_x, bottom, maxx - m_x, maxy - bottom, stroke=1, fill=0)
 
             c.drawString(10, 10, f"Page {row * cols + col + 1} (row {row+1}, col {col+1})")
 
@@ -247,7 +383,9 @@ def split_image_to_letter_overlap(image_path, output_pdf, poster_width=20, poste
 
             c.showPage()
 
-    c.save()
+        c.save()
+    finally:
+        rl_config.useA85 = use_a85
     print(f"PDF saved as: {output_pdf}")
     print(f"Sliced into {rows} rows and {cols} columns with {overlap_in}\" overlap.")
     print(f"Total pages: {rows * cols}")
@@ -273,6 +411,13 @@ def main():
                    help="Show how many pages will be needed without processing")
     p.add_argument("--no-rotate", action="store_true",
                      help="Disable automatic rotation of the image for fewer pages")
+    p.add_argument("--jpeg-quality", default=90, type=int,
+                   help="JPEG quality (1-95) used to embed colour pages (default: 90)")
+    p.add_argument("--colors", default=None, type=int,
+                   help="Reduce the image to at most this many colors (2-256) and embed pages losslessly; "
+                        "good for logos and line art (default: off)")
+    p.add_argument("-j", "--jobs", default=None, type=int,
+                   help="Number of pages to render in parallel (default: number of CPUs)")
     p.add_argument("image", help="Input image file name")
     p.add_argument("output", help="Output PDF file name")
     
@@ -281,6 +426,12 @@ def main():
     try:
         poster_width, poster_height = parse_size(args.size)
         margin_x, margin_y = parse_margin(args.margin)
+        if not 1 <= args.jpeg_quality <= 95:
+            raise ValueError(f"--jpeg-quality must be between 1 and 95, not {args.jpeg_quality}")
+        if args.colors is not None and not 2 <= args.colors <= 256:
+            raise ValueError(f"--colors must be between 2 and 256, not {args.colors}")
+        if args.jobs is not None and args.jobs < 1:
+            raise ValueError(f"--jobs must be at least 1, not {args.jobs}")
     except ValueError as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
@@ -329,9 +480,19 @@ def main():
         print(f"Pages needed: {cols} columns x {rows} rows = {cols * rows} total pages")
         print(f"With {args.dpi} DPI and {args.overlap}\" overlap")
         return
-    
+
+    # Image.open only reads the header, so this just checks the file is a
+    # readable image.  The path is passed on rather than the Image, so no
+    # reference here keeps the decoded pixels alive.
+    try:
+        with Image.open(args.image):
+            pass
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
     split_image_to_letter_overlap(
-        args.image, 
+        args.image,
         args.output, 
         poster_width=poster_width,
         poster_height=poster_height,
@@ -342,7 +503,10 @@ def main():
         line_color_str=args.line_color,
         margin_x=margin_x,
         margin_y=margin_y,
-        paper_size=paper_size
+        paper_size=paper_size,
+        jobs=args.jobs,
+        jpeg_quality=args.jpeg_quality,
+        num_colors=args.colors
     )
 
 if __name__ == '__main__':